@@ -1,11 +1,17 @@
 import asyncio
 import base64
+import collections
+import concurrent.futures
 import datetime
+import functools
 import hashlib
+import hmac
 import io
+import ipaddress
 import json
 import os
 import platform
+import queue
 import re
 import shutil
 import socket
@@ -15,20 +21,103 @@ import subprocess
 import threading
 import time
 import typing
+import urllib.parse
 import uuid
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
+import urllib3
 from herokutl.types import Message
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from .. import loader, utils
 from ..inline.types import InlineCall
 
 MAX_BODY_BYTES = 4 * 1024 * 1024
 WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_WS_GUID_BYTES = WS_GUID.encode("ascii")
+_WS_LEN16 = struct.Struct("!H")
+_WS_LEN64 = struct.Struct("!Q")
+_PUSH_COALESCE_DELAY = 0.005
+_MSG_PEEK_NOWAIT = (
+    socket.MSG_PEEK | socket.MSG_DONTWAIT if hasattr(socket, "MSG_DONTWAIT") else 0
+)
 OFFICIAL_UPDATE_BASE = "https://sosiskibot.ru/etg"
 OFFICIAL_SERVER_SCRIPT = "https://sosiskibot.ru/etg/etg_server.py"
 
+
+def _json_dumps(payload: typing.Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(payload, ensure_ascii=True).encode("utf-8")
+
+
+def _json_loads(raw: typing.Union[bytes, str]) -> typing.Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    if isinstance(raw, (bytes, bytearray)):
+        raw = raw.decode("utf-8")
+    return json.loads(raw)
+
+
+def _ws_unmask(
+    payload: bytearray, mask_key: bytes
+) -> typing.Union[bytes, bytearray]:
+    length = len(payload)
+    if numpy is not None and length >= 64:
+        buf = numpy.frombuffer(payload, dtype=numpy.uint8)
+        words = length // 4
+        lanes = buf[: words * 4].view(numpy.uint32)
+        lanes ^= numpy.frombuffer(mask_key, dtype=numpy.uint32)[0]
+        tail = length - words * 4
+        if tail:
+            buf[words * 4 :] ^= numpy.frombuffer(mask_key[:tail], dtype=numpy.uint8)
+        return payload
+    if not length:
+        return payload
+    mask = (mask_key * ((length + 3) // 4))[:length]
+    value = int.from_bytes(payload, "big") ^ int.from_bytes(mask, "big")
+    return value.to_bytes(length, "big")
+
+
+async def _run_bg(func: typing.Callable[..., typing.Any], *args: typing.Any) -> typing.Any:
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> typing.Optional[str]:
+    return shutil.which(name)
+
+
+_ERROR_BODIES = {
+    code: _json_dumps({"ok": False, "error": code})
+    for code in (
+        "missing_ws_key",
+        "not_found",
+        "payload_too_large",
+        "read_failed",
+        "invalid_json",
+        "bridge_missing",
+    )
+}
+
+_PLUGIN_URL_RE = re.compile(
+    r'^(?P<prefix>(?P<name>DEFAULT_SERVER_URL|DEFAULT_WS_URL)\s*=\s*)[\'"].*[\'"]',
+    re.M,
+)
+
 INSTALL_LANGS = [
     ("ru", "🇷🇺 Русский"),
     ("be", "🇧🇾 Беларуская"),
@@ -783,18 +872,24 @@ class _WebSocketConn:
         self.lock = threading.Lock()
         self.alive = True
         self.device_id: typing.Optional[str] = None
-
-    def _recv_exact(self, size: int) -> typing.Optional[bytes]:
-        data = b""
-        while len(data) < size:
+        self._closed = False
+        self._outbox: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _recv_exact(self, size: int) -> typing.Optional[bytearray]:
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
             try:
-                chunk = self.sock.recv(size - len(data))
+                count = self.sock.recv_into(view[got:])
             except socket.timeout:
                 return None
-            if not chunk:
+            if not count:
                 return None
-            data += chunk
-        return data
+            got += count
+        return buf
 
     def recv_text(self) -> typing.Optional[str]:
         header = self._recv_exact(2)
@@ -804,24 +899,26 @@ class _WebSocketConn:
         opcode = b1 & 0x0F
         masked = (b2 & 0x80) != 0
         length = b2 & 0x7F
-        if length == 126:
-            ext = self._recv_exact(2)
-            if not ext:
+        ext_len = 2 if length == 126 else 8 if length == 127 else 0
+        extra_len = ext_len + (4 if masked else 0)
+        extra = b""
+        if extra_len:
+            extra = self._recv_exact(extra_len)
+            if not extra:
                 return None
-            length = struct.unpack("!H", ext)[0]
+        if length == 126:
+            length = (extra[0] << 8) | extra[1]
         elif length == 127:
-            ext = self._recv_exact(8)
-            if not ext:
-                return None
-            length = struct.unpack("!Q", ext)[0]
-        mask_key = b""
-        if masked:
-            mask_key = self._recv_exact(4) or b""
-        payload = self._recv_exact(length) if length else b""
+            length = _WS_LEN64.unpack_from(extra)[0]
+        if length > MAX_BODY_BYTES:
+            self.alive = False
+            return None
+        mask_key = extra[ext_len:] if masked else b""
+        payload = self._recv_exact(length) if length else bytearray()
         if payload is None:
             return None
         if masked and mask_key:
-            payload = bytes(b ^ mask_key[i % 4] for i, b in enumerate(payload))
+            payload = _ws_unmask(payload, mask_key)
         if opcode == 0x8:
             self.alive = False
             return None
@@ -837,28 +934,90 @@ class _WebSocketConn:
         except Exception:
             return ""
 
-    def send_frame(self, opcode: int, payload: bytes) -> None:
-        if not self.alive:
-            return
-        header = bytearray()
-        header.append(0x80 | (opcode & 0x0F))
-        length = len(payload)
+    @staticmethod
+    def _frame_header(opcode: int, length: int) -> memoryview:
+        header = bytearray(10)
+        header[0] = 0x80 | (opcode & 0x0F)
         if length <= 125:
-            header.append(length)
+            header[1] = length
+            header_len = 2
         elif length < 65536:
-            header.append(126)
-            header.extend(struct.pack("!H", length))
+            header[1] = 126
+            _WS_LEN16.pack_into(header, 2, length)
+            header_len = 4
         else:
-            header.append(127)
-            header.extend(struct.pack("!Q", length))
-        with self.lock:
-            self.sock.sendall(header + payload)
+            header[1] = 127
+            _WS_LEN64.pack_into(header, 2, length)
+            header_len = 10
+        return memoryview(header)[:header_len]
+
+    def send_frame(self, opcode: int, payload: bytes) -> None:
+        if not self.alive:
+            return
+        self._outbox.put((self._frame_header(opcode, len(payload)), payload))
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            header, payload = item
+            try:
+                if isinstance(self.sock, ssl.SSLSocket) or not hasattr(self.sock, "sendmsg"):
+                    self.sock.sendall(bytes(header) + payload)
+                else:
+                    self._sendmsg_all([header, memoryview(payload)])
+            except Exception:
+                self.alive = False
+                try:
+                    self.sock.close()
+                except Exception:
+                    pass
+                return
+
+    def _sendmsg_all(self, buffers: typing.List[memoryview]) -> None:
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
 
     def send_text(self, text: str) -> None:
         self.send_frame(0x1, text.encode("utf-8"))
 
+    def send_text_bytes(self, data: bytes) -> None:
+        self.send_frame(0x1, data)
+
     def send_json(self, payload: dict) -> None:
-        self.send_text(json.dumps(payload, ensure_ascii=True))
+        self.send_text_bytes(_json_dumps(payload))
+
+    def has_buffered_text(self) -> bool:
+        if isinstance(self.sock, ssl.SSLSocket) or not _MSG_PEEK_NOWAIT:
+            return False
+        try:
+            head = self.sock.recv(14, _MSG_PEEK_NOWAIT)
+        except OSError:
+            return False
+        if len(head) < 2 or head[0] != 0x81:
+            return False
+        length = head[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(head) < 4:
+                return False
+            length = _WS_LEN16.unpack_from(head, 2)[0]
+            offset = 4
+        elif length == 127:
+            return False
+        if head[1] & 0x80:
+            offset += 4
+        total = offset + length
+        try:
+            return len(self.sock.recv(total, _MSG_PEEK_NOWAIT)) >= total
+        except OSError:
+            return False
 
     def send_ping(self) -> None:
         self.send_frame(0x9, b"ping")
@@ -867,13 +1026,16 @@ class _WebSocketConn:
         self.send_frame(0xA, payload)
 
     def close(self) -> None:
-        if not self.alive:
-            return
-        self.alive = False
-        try:
-            self.send_frame(0x8, b"")
-        except Exception:
-            pass
+        with self.lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self.alive:
+            self.alive = False
+            self._outbox.put((self._frame_header(0x8, 0), b""))
+        self._outbox.put(None)
+        if threading.current_thread() is not self._writer:
+            self._writer.join(timeout=2)
         try:
             self.sock.close()
         except Exception:
@@ -895,10 +1057,13 @@ class EtgBridgeAPI:
         action: str,
         payload: typing.Optional[dict] = None,
         ttl: int = 300,
+        callback_id: typing.Optional[str] = None,
     ) -> typing.Optional[str]:
         target = self._resolve(device_id)
         if not target:
             return None
+        if callback_id:
+            payload = dict(payload or {}, callback_id=callback_id)
         return self._mod.queue_action(target, action, payload, ttl)
 
     def toast(self, device_id: typing.Optional[str], text: str) -> typing.Optional[str]:
@@ -917,9 +1082,7 @@ class EtgBridgeAPI:
             "text": text,
             "buttons": buttons or ["OK"],
         }
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "dialog", payload)
+        return self.send(device_id, "dialog", payload, callback_id=callback_id)
 
     def menu(
         self,
@@ -930,9 +1093,7 @@ class EtgBridgeAPI:
         callback_id: typing.Optional[str] = None,
     ) -> typing.Optional[str]:
         payload = {"title": title, "message": message, "items": items}
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "menu", payload)
+        return self.send(device_id, "menu", payload, callback_id=callback_id)
 
     def prompt(
         self,
@@ -951,9 +1112,7 @@ class EtgBridgeAPI:
             "multiline": bool(multiline),
             "max_len": int(max_len) if max_len else 0,
         }
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "prompt", payload)
+        return self.send(device_id, "prompt", payload, callback_id=callback_id)
 
     def sheet(
         self,
@@ -962,12 +1121,7 @@ class EtgBridgeAPI:
         actions: typing.Optional[typing.List[str]] = None,
         callback_id: typing.Optional[str] = None,
     ) -> typing.Optional[str]:
-        payload = {"dsl": dsl}
-        if actions:
-            payload["actions"] = actions
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "sheet", payload)
+        return self.sheet_open(device_id, dsl, actions, callback_id)
 
     def sheet_open(
         self,
@@ -980,11 +1134,9 @@ class EtgBridgeAPI:
         payload = {"dsl": dsl}
         if actions:
             payload["actions"] = actions
-        if callback_id:
-            payload["callback_id"] = callback_id
         if sheet_id:
             payload["sheet_id"] = sheet_id
-        return self.send(device_id, "sheet", payload)
+        return self.send(device_id, "sheet", payload, callback_id=callback_id)
 
     def sheet_update(
         self,
@@ -997,9 +1149,7 @@ class EtgBridgeAPI:
         payload = {"sheet_id": sheet_id, "dsl": dsl}
         if actions:
             payload["actions"] = actions
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "sheet_update", payload)
+        return self.send(device_id, "sheet_update", payload, callback_id=callback_id)
 
     def sheet_close(
         self,
@@ -1023,9 +1173,7 @@ class EtgBridgeAPI:
             "filename": filename,
             "readonly": bool(readonly),
         }
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "open_editor", payload)
+        return self.send(device_id, "open_editor", payload, callback_id=callback_id)
 
     def ripple(
         self,
@@ -1046,9 +1194,7 @@ class EtgBridgeAPI:
         callback_id: typing.Optional[str] = None,
     ) -> typing.Optional[str]:
         payload = {"title": title}
-        if callback_id:
-            payload["callback_id"] = callback_id
-        return self.send(device_id, "select_chat", payload)
+        return self.send(device_id, "select_chat", payload, callback_id=callback_id)
 
     def open_url(self, device_id: typing.Optional[str], url: str) -> typing.Optional[str]:
         return self.send(device_id, "open_url", {"url": url})
@@ -1245,7 +1391,12 @@ class _BridgeHandler(BaseHTTPRequestHandler):
         return
 
     def _send_json(self, status: int, payload: dict) -> None:
-        data = json.dumps(payload, ensure_ascii=True).encode("utf-8")
+        self._send_body(status, _json_dumps(payload))
+
+    def _send_error_code(self, status: int, code: str) -> None:
+        self._send_body(status, _ERROR_BODIES[code])
+
+    def _send_body(self, status: int, data: bytes) -> None:
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(data)))
@@ -1260,10 +1411,11 @@ class _BridgeHandler(BaseHTTPRequestHandler):
     def _upgrade_ws(self) -> bool:
         key = (self.headers.get("Sec-WebSocket-Key") or "").strip()
         if not key:
-            self._send_json(400, {"ok": False, "error": "missing_ws_key"})
+            self._send_error_code(400, "missing_ws_key")
             return False
-        accept_raw = f"{key}{WS_GUID}".encode("utf-8")
-        accept = base64.b64encode(hashlib.sha1(accept_raw).digest()).decode("ascii")
+        digest = hashlib.sha1(key.encode("utf-8"))
+        digest.update(_WS_GUID_BYTES)
+        accept = base64.b64encode(digest.digest()).decode("ascii")
         self.send_response(101, "Switching Protocols")
         self.send_header("Upgrade", "websocket")
         self.send_header("Connection", "Upgrade")
@@ -1288,34 +1440,34 @@ class _BridgeHandler(BaseHTTPRequestHandler):
             bridge.handle_ws(conn, self.client_address[0])
             return
         if path == "/health":
-            self._send_json(200, {"ok": True, "ts": int(time.time() * 1000)})
+            self._send_body(200, b'{"ok":true,"ts":%d}' % int(time.time() * 1000))
             return
-        self._send_json(404, {"ok": False, "error": "not_found"})
+        self._send_error_code(404, "not_found")
 
     def do_POST(self) -> None:
         if self.path.rstrip("/") != "/sync":
-            self._send_json(404, {"ok": False, "error": "not_found"})
+            self._send_error_code(404, "not_found")
             return
         try:
             length = int(self.headers.get("Content-Length", "0"))
         except ValueError:
             length = 0
         if length <= 0 or length > MAX_BODY_BYTES:
-            self._send_json(413, {"ok": False, "error": "payload_too_large"})
+            self._send_error_code(413, "payload_too_large")
             return
         try:
             raw = self.rfile.read(length)
         except Exception:
-            self._send_json(400, {"ok": False, "error": "read_failed"})
+            self._send_error_code(400, "read_failed")
             return
         try:
-            payload = json.loads(raw.decode("utf-8"))
+            payload = _json_loads(raw)
         except Exception:
-            self._send_json(400, {"ok": False, "error": "invalid_json"})
+            self._send_error_code(400, "invalid_json")
             return
         bridge = getattr(self.server, "bridge", None)
         if bridge is None:
-            self._send_json(500, {"ok": False, "error": "bridge_missing"})
+            self._send_error_code(500, "bridge_missing")
             return
         status, response = bridge.handle_sync(payload, self.client_address[0])
         self._send_json(status, response)
@@ -1420,13 +1572,37 @@ class EtgBridgeMod(loader.Module):
         )
         self._server: typing.Optional[_BridgeHTTPServer] = None
         self._server_thread: typing.Optional[threading.Thread] = None
+        self._ssl_context: typing.Optional[ssl.SSLContext] = None
+        self._ssl_context_key: typing.Optional[tuple] = None
         self._devices: dict = {}
         self._lock = threading.Lock()
         self._last_error: typing.Optional[str] = None
+        self._auth_token_raw: typing.Optional[str] = None
+        self._auth_token = b""
         self._last_device_id: typing.Optional[str] = None
+        self._pending_waits: typing.Dict[
+            typing.Tuple[str, str],
+            typing.List[typing.Tuple[asyncio.AbstractEventLoop, asyncio.Event]],
+        ] = {}
         self._session = requests.Session()
         self._session.trust_env = False
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=8, pool_maxsize=16, max_retries=0
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        try:
+            requests.packages.urllib3.disable_warnings()  # type: ignore[attr-defined]
+        except Exception:
+            pass
+        self._local_pool: typing.Optional[urllib3.HTTPConnectionPool] = None
+        self._local_pool_key: typing.Optional[typing.Tuple[bool, int]] = None
         self._setup_log: typing.Optional[typing.List[str]] = None
+        self._devices_version = 0
+        self._status_cache: typing.Optional[typing.Tuple[float, tuple, str]] = None
+        self._push_dirty: typing.Set[str] = set()
+        self._push_event = threading.Event()
+        self._push_thread: typing.Optional[threading.Thread] = None
         self._pending_install: typing.Optional[dict] = None
         self._pending_task: typing.Optional[asyncio.Task] = None
         self.api = EtgBridgeAPI(self)
@@ -1439,6 +1615,9 @@ class EtgBridgeMod(loader.Module):
     async def on_unload(self):
         if not self._use_external():
             await self._stop_server()
+        if self._local_pool is not None:
+            self._local_pool.close()
+            self._local_pool = None
 
     def _use_external(self) -> bool:
         try:
@@ -1468,23 +1647,45 @@ class EtgBridgeMod(loader.Module):
                     raise FileNotFoundError(f"TLS cert not found: {cert_path}")
                 if not key_path or not os.path.isfile(key_path):
                     raise FileNotFoundError(f"TLS key not found: {key_path}")
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+                context = self._get_ssl_context(cert_path, key_path)
                 server.socket = context.wrap_socket(server.socket, server_side=True)
             thread = threading.Thread(target=server.serve_forever, daemon=True)
             thread.start()
             self._server = server
             self._server_thread = thread
+            push_thread = threading.Thread(target=self._push_loop, daemon=True)
+            self._push_thread = push_thread
+            push_thread.start()
             self._last_error = None
         except Exception as exc:
             self._last_error = str(exc)
 
+    def _get_ssl_context(self, cert_path: str, key_path: str) -> ssl.SSLContext:
+        key = (
+            cert_path,
+            key_path,
+            os.path.getmtime(cert_path),
+            os.path.getmtime(key_path),
+        )
+        if self._ssl_context is not None and self._ssl_context_key == key:
+            return self._ssl_context
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.options |= ssl.OP_NO_COMPRESSION
+        context.set_ciphers("ECDHE+AESGCM:ECDHE+CHACHA20")
+        context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+        self._ssl_context = context
+        self._ssl_context_key = key
+        return context
+
     async def _stop_server(self) -> None:
         server = self._server
         if server is None:
             return
+        self._push_thread = None
+        self._push_event.set()
         try:
-            await asyncio.to_thread(server.shutdown)
+            await _run_bg(server.shutdown)
         except Exception:
             pass
         try:
@@ -1494,10 +1695,6 @@ class EtgBridgeMod(loader.Module):
         self._server = None
         self._server_thread = None
 
-    def _local_base_url(self) -> str:
-        scheme = "https" if self.config["tls_enabled"] else "http"
-        return f"{scheme}://127.0.0.1:{self.config['listen_port']}"
-
     def _local_request(
         self,
         method: str,
@@ -1505,86 +1702,153 @@ class EtgBridgeMod(loader.Module):
         payload: typing.Optional[dict] = None,
         params: typing.Optional[dict] = None,
     ) -> typing.Tuple[typing.Optional[dict], str]:
-        url = self._local_base_url() + path
-        verify = True
-        if self.config["tls_enabled"]:
-            verify = False
-            try:
-                requests.packages.urllib3.disable_warnings()  # type: ignore[attr-defined]
-            except Exception:
-                pass
+        url = path
+        if params:
+            url = f"{path}?{urllib.parse.urlencode(params)}"
+        body = None
+        headers = None
+        if payload is not None:
+            body = _json_dumps(payload)
+            headers = {"Content-Type": "application/json"}
         try:
-            response = self._session.request(
-                method,
-                url,
-                json=payload,
-                params=params,
-                timeout=10,
-                verify=verify,
+            response = self._get_local_pool().urlopen(
+                method, url, body=body, headers=headers
             )
         except Exception as exc:
             return None, str(exc)
-        if response.status_code >= 400:
-            return None, f"http {response.status_code}: {response.text[:200]}"
+        if response.status >= 400:
+            text = response.data[:200].decode("utf-8", "replace")
+            return None, f"http {response.status}: {text}"
         try:
-            return response.json(), ""
+            return _json_loads(response.data), ""
         except Exception as exc:
             return None, f"bad json: {exc}"
 
+    def _get_local_pool(self) -> urllib3.HTTPConnectionPool:
+        key = (bool(self.config["tls_enabled"]), int(self.config["listen_port"]))
+        pool = self._local_pool
+        if pool is not None and self._local_pool_key == key:
+            return pool
+        tls_enabled, port = key
+        if tls_enabled:
+            pool = urllib3.HTTPSConnectionPool(
+                "127.0.0.1",
+                port=port,
+                maxsize=4,
+                timeout=10,
+                retries=False,
+                cert_reqs="CERT_NONE",
+                assert_hostname=False,
+            )
+        else:
+            pool = urllib3.HTTPConnectionPool(
+                "127.0.0.1",
+                port=port,
+                maxsize=4,
+                timeout=10,
+                retries=False,
+            )
+        old = self._local_pool
+        self._local_pool = pool
+        self._local_pool_key = key
+        if old is not None:
+            old.close()
+        return pool
+
     def _fetch_status(self) -> typing.Tuple[typing.Optional[dict], str]:
         return self._local_request("GET", "/status")
 
     def _get_device(self, device_id: str) -> dict:
         device = self._devices.get(device_id)
-        if device is None:
+        if device is not None:
+            return device
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                return device
             device = {
                 "id": device_id,
                 "created_at": time.time(),
                 "last_seen": 0.0,
                 "ip": "",
                 "info": {},
-                "queue": [],
-                "logs": [],
-                "results": [],
+                "queue": collections.deque(maxlen=self.config["max_queue"]),
+                "logs": collections.deque(maxlen=self.config["max_logs"]),
+                "results": collections.deque(maxlen=self.config["max_results"]),
+                "results_by_id": {},
                 "ws": None,
+                "due_at": 0.0,
+                "lock": threading.Lock(),
             }
             self._devices[device_id] = device
+            self._devices_version += 1
         return device
 
-    def _log_device(self, device: dict, text: str, level: str = "info") -> None:
+    def _log_device(
+        self,
+        device: dict,
+        text: str,
+        level: str = "info",
+        now: typing.Optional[float] = None,
+    ) -> None:
         entry = {
-            "ts": time.time(),
+            "ts": now or time.time(),
             "text": text,
             "level": level,
         }
         device["logs"].append(entry)
-        max_logs = self.config["max_logs"]
-        if len(device["logs"]) > max_logs:
-            del device["logs"][:-max_logs]
 
-    def _append_results(self, device: dict, results: list) -> None:
+    def _append_results(
+        self, device: dict, results: list, now: typing.Optional[float] = None
+    ) -> typing.List[str]:
+        ids: typing.List[str] = []
         if not results:
-            return
+            return ids
+        now = now or time.time()
+        stored = device["results"]
+        by_id = device["results_by_id"]
         for item in results:
-            if not isinstance(item, dict):
+            if type(item) is not dict:
+                continue
+            entry_id = str(item.get("id") or "")
+            if entry_id and entry_id in by_id:
+                ids.append(entry_id)
                 continue
             entry = {
-                "ts": time.time(),
-                "id": str(item.get("id") or ""),
+                "ts": now,
+                "id": entry_id,
                 "ok": bool(item.get("ok", False)),
                 "action": str(item.get("action") or ""),
                 "data": item.get("data"),
                 "error": str(item.get("error") or ""),
             }
-            device["results"].append(entry)
-        max_results = self.config["max_results"]
-        if len(device["results"]) > max_results:
-            del device["results"][:-max_results]
+            if len(stored) == stored.maxlen:
+                evicted = stored[0]
+                if by_id.get(evicted["id"]) is evicted:
+                    del by_id[evicted["id"]]
+            stored.append(entry)
+            if entry_id:
+                by_id[entry_id] = entry
+                ids.append(entry_id)
+            self._wake_waiters(device["id"], entry_id)
+        return ids
+
+    def _wake_waiters(self, device_id: str, action_id: str) -> None:
+        with self._lock:
+            waiters = self._pending_waits.pop((device_id, action_id), None)
+        for loop, event in waiters or ():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass
 
-    def _prune_queue(self, device: dict, ack_ids: set) -> None:
-        now = time.time()
-        new_queue = []
-        for item in device["queue"]:
+    def _prune_queue(
+        self, device: dict, ack_ids: set, now: typing.Optional[float] = None
+    ) -> None:
+        now = now or time.time()
+        queue = device["queue"]
+        new_queue = collections.deque(maxlen=queue.maxlen)
+        for item in queue:
             item_id = item.get("id")
             if item_id in ack_ids:
                 continue
@@ -1595,32 +1859,25 @@ class EtgBridgeMod(loader.Module):
             new_queue.append(item)
         device["queue"] = new_queue
 
-    def _collect_actions(self, device: dict) -> list:
-        now = time.time()
+    def _collect_actions(self, device: dict, now: typing.Optional[float] = None) -> list:
+        now = now or time.time()
+        if now < device["due_at"]:
+            return []
         resend_after = self.config["resend_after"]
         actions = []
+        due_at = float("inf")
         for item in device["queue"]:
             sent_ts = float(item.get("sent_ts") or 0)
             if sent_ts and now - sent_ts < resend_after:
+                due_at = min(due_at, sent_ts + resend_after)
                 continue
             item["sent_ts"] = now
-            actions.append(
-                {
-                    "id": item.get("id"),
-                    "action": item.get("action"),
-                    "payload": item.get("payload"),
-                    "ttl": item.get("ttl"),
-                    "ts": item.get("ts"),
-                }
-            )
+            actions.append(item["wire"])
+        if actions:
+            due_at = min(due_at, now + resend_after)
+        device["due_at"] = due_at
         return actions
 
-    def _find_result_index(self, device: dict, action_id: str) -> typing.Optional[int]:
-        for idx, item in enumerate(device.get("results") or []):
-            if str(item.get("id") or "") == action_id:
-                return idx
-        return None
-
     def get_result(
         self,
         device_id: str,
@@ -1640,14 +1897,19 @@ class EtgBridgeMod(loader.Module):
             if data and data.get("ok"):
                 return data.get("result")
             return None
-        with self._lock:
-            device = self._get_device(device_id)
-            idx = self._find_result_index(device, action_id)
-            if idx is None:
+        device = self._get_device(device_id)
+        with device["lock"]:
+            item = device["results_by_id"].get(action_id)
+            if item is None:
                 return None
-            item = device["results"][idx]
             if pop:
-                device["results"].pop(idx)
+                del device["results_by_id"][action_id]
+                stored = device["results"]
+                for index, entry in enumerate(stored):
+                    if entry is item:
+                        del stored[index]
+                        break
+                self._devices_version += 1
             return item
 
     async def wait_result(
@@ -1657,13 +1919,34 @@ class EtgBridgeMod(loader.Module):
         timeout: int = 30,
         pop: bool = True,
     ) -> typing.Optional[dict]:
-        end = time.time() + max(1, timeout)
-        while time.time() < end:
+        if self._use_external():
+            end = time.time() + max(1, timeout)
+            while time.time() < end:
+                item = await _run_bg(self.get_result, device_id, action_id, pop)
+                if item is not None:
+                    return item
+                await asyncio.sleep(0.5)
+            return None
+        key = (device_id, action_id)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._pending_waits.setdefault(key, []).append(waiter)
+        try:
             item = self.get_result(device_id, action_id, pop=pop)
             if item is not None:
                 return item
-            await asyncio.sleep(0.5)
-        return None
+            try:
+                await asyncio.wait_for(waiter[1].wait(), timeout=max(1, timeout))
+            except asyncio.TimeoutError:
+                return None
+            return self.get_result(device_id, action_id, pop=pop)
+        finally:
+            with self._lock:
+                waiters = self._pending_waits.get(key)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._pending_waits[key]
 
     def queue_action(
         self,
@@ -1688,100 +1971,135 @@ class EtgBridgeMod(loader.Module):
             self._last_error = err or (data.get("error") if data else "queue_failed")
             return ""
         action_id = uuid.uuid4().hex
-        ws_conn = None
-        actions = []
-        with self._lock:
-            device = self._get_device(device_id)
-            item = {
+        device = self._get_device(device_id)
+        now = time.time()
+        with device["lock"]:
+            wire = {
                 "id": action_id,
                 "action": action,
                 "payload": payload or {},
                 "ttl": ttl,
-                "ts": time.time(),
-                "sent_ts": 0.0,
+                "ts": now,
             }
+            item = dict(wire, sent_ts=0.0, wire=wire)
             device["queue"].append(item)
-            max_queue = self.config["max_queue"]
-            if len(device["queue"]) > max_queue:
-                device["queue"] = device["queue"][-max_queue:]
-            self._log_device(device, f"queued {action} id={action_id}")
+            device["due_at"] = 0.0
+            self._log_device(device, f"queued {action} id={action_id}", now=now)
             ws_conn = device.get("ws")
-            if ws_conn and getattr(ws_conn, "alive", False):
-                actions = self._collect_actions(device)
-        if ws_conn and actions:
-            self._send_ws_actions(ws_conn, device_id, actions, "push")
+            push = ws_conn is not None and ws_conn.alive
+        self._devices_version += 1
+        if push:
+            with self._lock:
+                self._push_dirty.add(device_id)
+                self._push_event.set()
         return action_id
 
+    def _push_loop(self) -> None:
+        event = self._push_event
+        while self._push_thread is threading.current_thread():
+            event.wait()
+            time.sleep(_PUSH_COALESCE_DELAY)
+            with self._lock:
+                event.clear()
+                dirty = self._push_dirty
+                self._push_dirty = set()
+            for device_id in dirty:
+                self._flush_ws_push(device_id)
+
+    def _flush_ws_push(self, device_id: str) -> None:
+        device = self._devices.get(device_id)
+        if device is None:
+            return
+        now = time.time()
+        with device["lock"]:
+            conn = device.get("ws")
+            if conn is None or not conn.alive:
+                return
+            actions = self._collect_actions(device, now)
+        if actions:
+            self._send_ws_actions(conn, device_id, actions, "push", now)
+
+    def _get_auth_token(self) -> bytes:
+        raw = self.config["auth_token"] or ""
+        if raw != self._auth_token_raw:
+            self._auth_token = raw.strip().encode("utf-8")
+            self._auth_token_raw = raw
+        return self._auth_token
+
     def handle_sync(self, payload: dict, client_ip: str) -> typing.Tuple[int, dict]:
-        if not isinstance(payload, dict):
+        if type(payload) is not dict:
             return 400, {"ok": False, "error": "invalid_payload"}
-        token = self.config["auth_token"].strip()
+        token = self._get_auth_token()
         if token:
-            if payload.get("token") != token:
+            supplied = payload.get("token")
+            if not isinstance(supplied, str) or not hmac.compare_digest(
+                supplied.encode("utf-8"), token
+            ):
                 return 401, {"ok": False, "error": "unauthorized"}
         device_id = str(payload.get("device_id") or "").strip()
         if not device_id:
             return 400, {"ok": False, "error": "missing_device_id"}
-        with self._lock:
-            device = self._get_device(device_id)
-            device["last_seen"] = time.time()
+        self._last_device_id = device_id
+        device = self._get_device(device_id)
+        now = time.time()
+        with device["lock"]:
+            device["last_seen"] = now
             device["ip"] = client_ip
             info = payload.get("info")
-            if isinstance(info, dict):
+            if type(info) is dict:
                 device["info"] = info
-            self._last_device_id = device_id
 
             logs = payload.get("logs")
-            if isinstance(logs, list):
+            if type(logs) is list:
+                log_device = self._log_device
                 for entry in logs:
-                    if isinstance(entry, dict):
-                        text = entry.get("text") or ""
-                    else:
-                        text = str(entry)
+                    text = (entry.get("text") or "") if type(entry) is dict else str(entry)
                     if text:
-                        self._log_device(device, text)
+                        log_device(device, text, now=now)
 
-            results = payload.get("results")
-            if isinstance(results, list):
-                self._append_results(device, results)
-
-            ack_ids = set()
             ack = payload.get("ack")
-            if isinstance(ack, list):
-                ack_ids.update(str(x) for x in ack if x)
-            if isinstance(results, list):
-                ack_ids.update(str(x.get("id")) for x in results if isinstance(x, dict) and x.get("id"))
-            self._prune_queue(device, ack_ids)
+            ack_ids = {str(x) for x in ack if x} if type(ack) is list else set()
+            results = payload.get("results")
+            if type(results) is list:
+                ack_ids.update(self._append_results(device, results, now))
+            self._prune_queue(device, ack_ids, now)
 
-            actions = self._collect_actions(device)
+            actions = self._collect_actions(device, now)
+        self._devices_version += 1
 
         response = {
             "ok": True,
             "device_id": device_id,
-            "server_ts": int(time.time() * 1000),
+            "server_ts": int(now * 1000),
             "actions": actions,
         }
         return 200, response
 
     def _bind_ws(self, device_id: str, conn: _WebSocketConn) -> None:
-        with self._lock:
-            device = self._get_device(device_id)
+        device = self._get_device(device_id)
+        with device["lock"]:
             old = device.get("ws")
-            if old and old is not conn:
-                try:
-                    old.close()
-                except Exception:
-                    pass
+            if old is conn:
+                return
             device["ws"] = conn
+        self._devices_version += 1
+        if old:
+            try:
+                old.close()
+            except Exception:
+                pass
 
     def _unbind_ws(self, conn: _WebSocketConn) -> None:
         device_id = conn.device_id
         if not device_id:
             return
-        with self._lock:
-            device = self._devices.get(device_id)
-            if device and device.get("ws") is conn:
+        device = self._devices.get(device_id)
+        if device is None:
+            return
+        with device["lock"]:
+            if device.get("ws") is conn:
                 device["ws"] = None
+        self._devices_version += 1
 
     def _send_ws_actions(
         self,
@@ -1789,11 +2107,12 @@ class EtgBridgeMod(loader.Module):
         device_id: str,
         actions: list,
         reason: str,
+        now: typing.Optional[float] = None,
     ) -> None:
         payload = {
             "ok": True,
             "device_id": device_id,
-            "server_ts": int(time.time() * 1000),
+            "server_ts": int((now or time.time()) * 1000),
             "actions": actions,
             "type": reason,
         }
@@ -1804,18 +2123,42 @@ class EtgBridgeMod(loader.Module):
             self._unbind_ws(conn)
             self._last_error = f"ws send failed: {exc}"
 
+    @staticmethod
+    def _merge_ws_responses(first: dict, second: dict) -> typing.Optional[dict]:
+        if not (first.get("ok") and second.get("ok")):
+            return None
+        if first.get("device_id") != second.get("device_id"):
+            return None
+        actions = list(second["actions"])
+        if first["actions"]:
+            seen = {action.get("id") for action in actions}
+            actions[:0] = [
+                action for action in first["actions"] if action.get("id") not in seen
+            ]
+        second["actions"] = actions
+        return second
+
     def handle_ws(self, conn: _WebSocketConn, client_ip: str) -> None:
+        deferred: typing.Optional[dict] = None
         try:
             while conn.alive:
+                if deferred is not None and not conn.has_buffered_text():
+                    conn.send_json(deferred)
+                    deferred = None
                 msg = conn.recv_text()
                 if msg is None:
+                    if deferred is not None:
+                        conn.send_json(deferred)
                     break
                 if not msg:
                     continue
                 try:
-                    payload = json.loads(msg)
+                    payload = _json_loads(msg)
                 except Exception:
-                    conn.send_json({"ok": False, "error": "invalid_json"})
+                    if deferred is not None:
+                        conn.send_json(deferred)
+                        deferred = None
+                    conn.send_text_bytes(_ERROR_BODIES["invalid_json"])
                     continue
                 status, response = self.handle_sync(payload, client_ip)
                 device_id = response.get("device_id") or payload.get("device_id")
@@ -1826,11 +2169,17 @@ class EtgBridgeMod(loader.Module):
                     response["ok"] = False
                     response["code"] = status
                 response.setdefault("type", "sync")
-                conn.send_json(response)
+                if deferred is not None:
+                    merged = self._merge_ws_responses(deferred, response)
+                    if merged is None:
+                        conn.send_json(deferred)
+                    else:
+                        response = merged
+                deferred = response
         except Exception as exc:
             if conn.device_id:
-                with self._lock:
-                    device = self._get_device(conn.device_id)
+                device = self._get_device(conn.device_id)
+                with device["lock"]:
                     self._log_device(device, f"ws error: {exc}", "error")
         finally:
             self._unbind_ws(conn)
@@ -1840,37 +2189,42 @@ class EtgBridgeMod(loader.Module):
         seconds = int(max(0, seconds))
         if seconds < 60:
             return f"{seconds}s"
-        minutes, sec = divmod(seconds, 60)
+        minutes = seconds // 60
         if minutes < 60:
-            return f"{minutes}m {sec}s"
-        hours, minutes = divmod(minutes, 60)
+            return f"{minutes}m {seconds - minutes * 60}s"
+        hours = minutes // 60
         if hours < 24:
-            return f"{hours}h {minutes}m"
-        days, hours = divmod(hours, 24)
-        return f"{days}d {hours}h"
-
-    def _render_device_line(self, device: dict) -> str:
-        now = time.time()
-        last_seen = device.get("last_seen") or 0
+            return f"{hours}h {minutes - hours * 60}m"
+        days = hours // 24
+        return f"{days}d {hours - days * 24}h"
+
+    def _render_device_line(self, device: dict, now: typing.Optional[float] = None) -> str:
+        get = device.get
+        if now is None:
+            now = time.time()
+        last_seen = get("last_seen") or 0
         age = self._format_age(now - float(last_seen)) if last_seen else "never"
-        info = device.get("info") or {}
-        name = info.get("device_name") or info.get("name") or device.get("id") or "unknown"
-        queue_len = device.get("queue")
-        logs_len = device.get("logs")
-        results_len = device.get("results")
+        info = get("info") or {}
+        name = info.get("device_name") or info.get("name") or get("id") or "unknown"
+        queue_len = get("queue")
+        logs_len = get("logs")
+        results_len = get("results")
         if not isinstance(queue_len, int):
-            queue_len = len(device.get("queue") or [])
+            queue_len = len(queue_len or ())
         if not isinstance(logs_len, int):
-            logs_len = len(device.get("logs") or [])
+            logs_len = len(logs_len or ())
         if not isinstance(results_len, int):
-            results_len = len(device.get("results") or [])
-        transport = device.get("transport")
+            results_len = len(results_len or ())
+        transport = get("transport")
         if not transport:
-            ws_conn = device.get("ws")
+            ws_conn = get("ws")
             transport = "ws" if ws_conn and getattr(ws_conn, "alive", False) else "http"
-        return (
-            f"- {name} ({device['id']}) | seen {age} | {transport} | "
-            f"q={queue_len} logs={logs_len} results={results_len}"
+        return "".join(
+            (
+                "- ", str(name), " (", str(device["id"]), ") | seen ", age,
+                " | ", str(transport), " | q=", str(queue_len),
+                " logs=", str(logs_len), " results=", str(results_len),
+            )
         )
 
     def _pick_device(self, raw: str) -> typing.Optional[str]:
@@ -1978,7 +2332,7 @@ class EtgBridgeMod(loader.Module):
                 return ctx
         except Exception:
             pass
-        sudo_path = shutil.which("sudo") or ""
+        sudo_path = _which("sudo") or ""
         if not sudo_path:
             return ctx
         ctx["sudo_available"] = True
@@ -2066,6 +2420,15 @@ class EtgBridgeMod(loader.Module):
         except Exception as exc:
             return 1, str(exc)
 
+    def _systemctl_batch(self, actions: typing.List[str]) -> typing.Tuple[int, str]:
+        if len(actions) == 1:
+            return self._exec_shell(["systemctl"] + actions[0].split())
+        steps = "; ".join(
+            f'systemctl {action} || {{ echo "systemctl {action}: failed"; rc=1; }}'
+            for action in actions
+        )
+        return self._exec_shell(["sh", "-c", f"rc=0; {steps}; exit $rc"])
+
     @staticmethod
     def _exec_shell_input(
         args: typing.List[str],
@@ -2085,6 +2448,7 @@ class EtgBridgeMod(loader.Module):
             return 1, str(exc)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _etg_root() -> str:
         return os.path.normpath(
             os.path.join(utils.get_base_dir(), "..", "modules", "ETG")
@@ -2106,8 +2470,10 @@ class EtgBridgeMod(loader.Module):
         except Exception:
             return ""
 
-    @staticmethod
-    def _write_file(path: str, text: str) -> bool:
+    @classmethod
+    def _write_file(cls, path: str, text: str) -> bool:
+        if text and cls._read_file(path) == text:
+            return True
         try:
             with open(path, "w", encoding="utf-8") as handle:
                 handle.write(text)
@@ -2132,9 +2498,13 @@ class EtgBridgeMod(loader.Module):
             "max_results": int(self.config["max_results"]),
             "resend_after": int(self.config["resend_after"]),
         }
+        text = json.dumps(payload, ensure_ascii=True, indent=2)
+        if self._read_file(path) == text:
+            logs.append(f"server config: {path}")
+            return
         try:
             with open(path, "w", encoding="utf-8") as handle:
-                json.dump(payload, handle, ensure_ascii=True, indent=2)
+                handle.write(text)
             logs.append(f"server config: {path}")
         except Exception as exc:
             logs.append(f"server config write failed: {exc}")
@@ -2143,7 +2513,7 @@ class EtgBridgeMod(loader.Module):
         if self._is_windows():
             logs.append("systemd: not supported on Windows")
             return
-        if not shutil.which("systemctl"):
+        if not _which("systemctl"):
             logs.append("systemd: systemctl not available")
             return
         server_path = self._etg_server_path(root)
@@ -2154,7 +2524,7 @@ class EtgBridgeMod(loader.Module):
             os.path.join(utils.get_base_dir(), "..", "venv", "bin", "python")
         )
         if not os.path.isfile(venv_python):
-            venv_python = shutil.which("python3") or shutil.which("python") or "python3"
+            venv_python = _which("python3") or _which("python") or "python3"
         service_text = (
             "[Unit]\n"
             "Description=ETG Bridge Server\n"
@@ -2174,12 +2544,10 @@ class EtgBridgeMod(loader.Module):
         if not self._write_file(service_path, service_text):
             logs.append("systemd: failed to write service")
             return
-        code, out = self._exec_shell(["systemctl", "daemon-reload"])
-        logs.append("systemd: daemon-reload ok" if code == 0 else f"systemd: {out}")
-        code, out = self._exec_shell(["systemctl", "enable", "--now", "etg-bridge.service"])
-        logs.append("systemd: enable ok" if code == 0 else f"systemd: {out}")
-        code, out = self._exec_shell(["systemctl", "restart", "etg-bridge.service"])
-        logs.append("systemd: restart ok" if code == 0 else f"systemd: {out}")
+        code, out = self._systemctl_batch(
+            ["daemon-reload", "enable etg-bridge.service", "restart etg-bridge.service"]
+        )
+        logs.append("systemd: daemon-reload, enable, restart ok" if code == 0 else f"systemd: {out}")
 
     def _check_local_health(self, logs: typing.List[str]) -> None:
         data, err = self._local_request("GET", "/health")
@@ -2233,7 +2601,7 @@ class EtgBridgeMod(loader.Module):
     def _sudo_command(self, args: typing.List[str], logs: typing.List[str]) -> typing.Optional[typing.List[str]]:
         if os.geteuid() == 0:
             return args
-        sudo = shutil.which("sudo")
+        sudo = _which("sudo")
         if not sudo:
             logs.append("sudo: not available, install ufw manually")
             return None
@@ -2258,7 +2626,7 @@ class EtgBridgeMod(loader.Module):
         return False
 
     def _install_ufw(self, logs: typing.List[str], sudo_ctx: dict) -> bool:
-        if shutil.which("ufw"):
+        if _which("ufw"):
             return True
         osr = self._read_os_release()
         if osr:
@@ -2267,17 +2635,17 @@ class EtgBridgeMod(loader.Module):
             logs.append(f"os-release: {os_id} {os_like}".strip())
 
         installers = []
-        if shutil.which("apt-get") or shutil.which("apt"):
+        if _which("apt-get") or _which("apt"):
             installers.append((["apt-get", "install", "-y", "ufw"], "apt-get install ufw"))
-        if shutil.which("dnf"):
+        if _which("dnf"):
             installers.append((["dnf", "-y", "install", "ufw"], "dnf install ufw"))
-        if shutil.which("yum"):
+        if _which("yum"):
             installers.append((["yum", "-y", "install", "ufw"], "yum install ufw"))
-        if shutil.which("pacman"):
+        if _which("pacman"):
             installers.append((["pacman", "-Sy", "--noconfirm", "ufw"], "pacman install ufw"))
-        if shutil.which("zypper"):
+        if _which("zypper"):
             installers.append((["zypper", "--non-interactive", "install", "ufw"], "zypper install ufw"))
-        if shutil.which("apk"):
+        if _which("apk"):
             installers.append((["apk", "add", "--no-cache", "ufw"], "apk add ufw"))
 
         if not installers:
@@ -2286,12 +2654,13 @@ class EtgBridgeMod(loader.Module):
 
         for cmd, label in installers:
             if self._run_pkg_command(cmd, logs, label, sudo_ctx):
-                if shutil.which("ufw"):
+                _which.cache_clear()
+                if _which("ufw"):
                     logs.append("ufw: installed")
                     return True
-        if not shutil.which("ufw"):
+        if not _which("ufw"):
             logs.append("ufw: install failed")
-        return shutil.which("ufw") is not None
+        return _which("ufw") is not None
 
     def _run_shell_with_fallback(
         self,
@@ -2365,7 +2734,7 @@ class EtgBridgeMod(loader.Module):
 
         if _attempt(True) or _attempt(False):
             return True
-        if not shutil.which("ufw"):
+        if not _which("ufw"):
             logs.append("ufw: not installed, attempting install")
             self._install_ufw(logs, sudo_ctx)
         if _attempt(True) or _attempt(False):
@@ -2393,17 +2762,17 @@ class EtgBridgeMod(loader.Module):
     def _get_ufw_install_command(self) -> str:
         if self._is_windows():
             return ""
-        if shutil.which("apt-get") or shutil.which("apt"):
+        if _which("apt-get") or _which("apt"):
             return "sudo apt-get install -y ufw"
-        if shutil.which("dnf"):
+        if _which("dnf"):
             return "sudo dnf -y install ufw"
-        if shutil.which("yum"):
+        if _which("yum"):
             return "sudo yum -y install ufw"
-        if shutil.which("pacman"):
+        if _which("pacman"):
             return "sudo pacman -Sy --noconfirm ufw"
-        if shutil.which("zypper"):
+        if _which("zypper"):
             return "sudo zypper --non-interactive install ufw"
-        if shutil.which("apk"):
+        if _which("apk"):
             return "sudo apk add --no-cache ufw"
         return ""
 
@@ -2554,9 +2923,9 @@ class EtgBridgeMod(loader.Module):
                 return
             chat_id = utils.get_chat_id(message)
         await self._client.send_message(chat_id, text)
-        if etg_file and os.path.isfile(etg_file):
+        if etg_file:
             await self._client.send_file(chat_id, etg_file)
-        if mandre_file and os.path.isfile(mandre_file):
+        if mandre_file:
             await self._client.send_file(chat_id, mandre_file)
 
     def _allow_ports(self, ports: typing.List[int], logs: typing.List[str]) -> None:
@@ -2570,34 +2939,34 @@ class EtgBridgeMod(loader.Module):
         os.makedirs(release_dir, exist_ok=True)
         os.makedirs(beta_dir, exist_ok=True)
 
-        def download(url: str, dst: str) -> bool:
+        def download(url: str, dst: str) -> str:
             try:
-                try:
-                    requests.packages.urllib3.disable_warnings()  # type: ignore[attr-defined]
-                except Exception:
-                    pass
                 resp = self._session.get(url, timeout=30, verify=False)
                 if resp.status_code != 200:
-                    logs.append(f"download failed {url}: http {resp.status_code}")
-                    return False
+                    return f"download failed {url}: http {resp.status_code}"
                 with open(dst, "wb") as handle:
                     handle.write(resp.content)
-                return True
+                return ""
             except Exception as exc:
-                logs.append(f"download failed {url}: {exc}")
-                return False
+                return f"download failed {url}: {exc}"
 
-        copied: typing.Dict[str, str] = {}
         base = OFFICIAL_UPDATE_BASE.rstrip("/")
-        for branch, target_dir in (("release", release_dir), ("beta", beta_dir)):
-            for name in ("EtgBridge.plugin", "mandre_lib.plugin"):
-                url = f"{base}/{branch}/{name}"
-                dst = os.path.join(target_dir, name)
-                if download(url, dst):
-                    if branch == "release":
-                        copied[name] = dst
-                else:
-                    logs.append(f"missing remote: {url}")
+        jobs = [
+            (f"{base}/{branch}/{name}", os.path.join(target_dir, name), branch, name)
+            for branch, target_dir in (("release", release_dir), ("beta", beta_dir))
+            for name in ("EtgBridge.plugin", "mandre_lib.plugin")
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            errors = list(executor.map(lambda job: download(job[0], job[1]), jobs))
+
+        copied: typing.Dict[str, str] = {}
+        for (url, dst, branch, name), error in zip(jobs, errors):
+            if not error:
+                if branch == "release":
+                    copied[name] = dst
+            else:
+                logs.append(error)
+                logs.append(f"missing remote: {url}")
         return copied
 
     def _patch_plugin_defaults(
@@ -2609,19 +2978,13 @@ class EtgBridgeMod(loader.Module):
     ) -> None:
         raw = self._read_file(plugin_path)
         if not raw:
-            logs.append(f"plugin patch failed: {os.path.basename(plugin_path)}")
+            if os.path.isfile(plugin_path):
+                logs.append(f"plugin patch failed: {os.path.basename(plugin_path)}")
             return
-        updated = re.sub(
-            r'^(DEFAULT_SERVER_URL\s*=\s*)[\'"].*[\'"]',
-            rf'\1"{sync_url}"',
+        urls = {"DEFAULT_SERVER_URL": sync_url, "DEFAULT_WS_URL": ws_url}
+        updated = _PLUGIN_URL_RE.sub(
+            lambda match: f'{match.group("prefix")}"{urls[match.group("name")]}"',
             raw,
-            flags=re.M,
-        )
-        updated = re.sub(
-            r'^(DEFAULT_WS_URL\s*=\s*)[\'"].*[\'"]',
-            rf'\1"{ws_url}"',
-            updated,
-            flags=re.M,
         )
         if updated != raw:
             if self._write_file(plugin_path, updated):
@@ -2630,22 +2993,31 @@ class EtgBridgeMod(loader.Module):
                 logs.append(f"plugin patch write failed: {plugin_path}")
 
     def _get_external_ip(self, logs: typing.List[str]) -> str:
-        session = requests.Session()
-        session.trust_env = False
         providers = [
             "https://api.ipify.org",
             "https://ifconfig.me/ip",
             "https://ipinfo.io/ip",
         ]
-        for url in providers:
-            try:
-                response = session.get(url, timeout=10)
-                if response.status_code == 200:
-                    ip = response.text.strip()
-                    if ip:
-                        return ip
-            except Exception as exc:
-                logs.append(f"ip check failed {url}: {exc}")
+
+        def fetch(url: str) -> str:
+            response = self._session.get(url, timeout=10)
+            if response.status_code == 200:
+                return response.text.strip()
+            return ""
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(providers))
+        try:
+            futures = {executor.submit(fetch, url): url for url in providers}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    ip = future.result()
+                except Exception as exc:
+                    logs.append(f"ip check failed {futures[future]}: {exc}")
+                    continue
+                if ip:
+                    return ip
+        finally:
+            executor.shutdown(wait=False)
         return ""
 
     @staticmethod
@@ -2661,20 +3033,14 @@ class EtgBridgeMod(loader.Module):
 
     @staticmethod
     def _is_private_ip(ip: str) -> bool:
-        return (
-            ip.startswith("10.")
-            or ip.startswith("192.168.")
-            or ip.startswith("172.16.")
-            or ip.startswith("172.17.")
-            or ip.startswith("172.18.")
-            or ip.startswith("172.19.")
-            or ip.startswith("172.2")
-            or ip.startswith("172.3")
-        )
+        try:
+            return ipaddress.ip_address(ip).is_private
+        except ValueError:
+            return False
 
     @staticmethod
     def _parse_port(value: str) -> typing.Optional[int]:
-        if not value or not value.isdigit():
+        if not value or len(value) > 5 or not (value.isascii() and value.isdigit()):
             return None
         port = int(value)
         if port < 1 or port > 65535:
@@ -2699,14 +3065,8 @@ class EtgBridgeMod(loader.Module):
     def _probe_health(self, port: int) -> bool:
         scheme = "https" if self.config["tls_enabled"] else "http"
         url = f"{scheme}://127.0.0.1:{port}/health"
-        verify = not bool(self.config["tls_enabled"])
         try:
-            if not verify:
-                try:
-                    requests.packages.urllib3.disable_warnings()  # type: ignore[attr-defined]
-                except Exception:
-                    pass
-            resp = self._session.get(url, timeout=4, verify=verify)
+            resp = self._session.get(url, timeout=4, verify=False)
         except Exception:
             return False
         if resp.status_code != 200:
@@ -2723,6 +3083,7 @@ class EtgBridgeMod(loader.Module):
         sudo_ctx: dict,
     ) -> typing.Tuple[typing.List[str], str, str, dict]:
         logs: typing.List[str] = []
+        _which.cache_clear()
         root = self._etg_root()
         os.makedirs(root, exist_ok=True)
         self.config["listen_port"] = int(port)
@@ -2786,10 +3147,8 @@ class EtgBridgeMod(loader.Module):
             release_dir, "EtgBridge.plugin"
         )
         beta_plugin = os.path.join(beta_dir, "EtgBridge.plugin")
-        if os.path.isfile(release_plugin):
-            self._patch_plugin_defaults(release_plugin, sync_url, ws_url, logs)
-        if os.path.isfile(beta_plugin):
-            self._patch_plugin_defaults(beta_plugin, sync_url, ws_url, logs)
+        self._patch_plugin_defaults(release_plugin, sync_url, ws_url, logs)
+        self._patch_plugin_defaults(beta_plugin, sync_url, ws_url, logs)
 
         auth_token = (self.config["auth_token"] or "").strip()
         token_line = f"Token: {auth_token}" if auth_token else "Token: (не задан)"
@@ -2828,25 +3187,28 @@ class EtgBridgeMod(loader.Module):
     def _run_uninstall(self) -> typing.List[str]:
         logs: typing.List[str] = []
         service_path = "/etc/systemd/system/etg-bridge.service"
-        code, out = self._exec_shell(["systemctl", "stop", "etg-bridge.service"])
-        logs.append("systemd: stop ok" if code == 0 else f"systemd: stop {out}")
-        code, out = self._exec_shell(["systemctl", "disable", "etg-bridge.service"])
-        logs.append("systemd: disable ok" if code == 0 else f"systemd: disable {out}")
-        if os.path.isfile(service_path):
-            try:
-                os.remove(service_path)
-                logs.append("systemd: service removed")
-            except Exception as exc:
-                logs.append(f"systemd: remove failed: {exc}")
-        code, out = self._exec_shell(["systemctl", "daemon-reload"])
-        logs.append("systemd: daemon-reload ok" if code == 0 else f"systemd: {out}")
+        code, out = self._systemctl_batch(["disable --now etg-bridge.service"])
+        logs.append("systemd: stop, disable ok" if code == 0 else f"systemd: disable {out}")
+        removed = False
+        try:
+            os.remove(service_path)
+            removed = True
+            logs.append("systemd: service removed")
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            logs.append(f"systemd: remove failed: {exc}")
+        if removed:
+            code, out = self._systemctl_batch(["daemon-reload"])
+            logs.append("systemd: daemon-reload ok" if code == 0 else f"systemd: {out}")
         cfg_path = self._etg_config_path(self._etg_root())
-        if os.path.isfile(cfg_path):
-            try:
-                os.remove(cfg_path)
-                logs.append(f"config removed: {cfg_path}")
-            except Exception as exc:
-                logs.append(f"config remove failed: {exc}")
+        try:
+            os.remove(cfg_path)
+            logs.append(f"config removed: {cfg_path}")
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            logs.append(f"config remove failed: {exc}")
         self._set_setup_log(logs)
         return logs
 
@@ -2855,12 +3217,21 @@ class EtgBridgeMod(loader.Module):
         release_dir = os.path.join(root, "release")
         etg_file = os.path.join(release_dir, "EtgBridge.plugin")
         mandre_file = os.path.join(release_dir, "mandre_lib.plugin")
-        if not os.path.isfile(etg_file) or not os.path.isfile(mandre_file):
-            self._copy_etg_files(logs)
-        if not os.path.isfile(etg_file):
+        try:
+            with os.scandir(release_dir) as entries:
+                present = {entry.name for entry in entries if entry.is_file()}
+        except OSError:
+            present = set()
+        has_etg = "EtgBridge.plugin" in present
+        has_mandre = "mandre_lib.plugin" in present
+        if not (has_etg and has_mandre):
+            copied = self._copy_etg_files(logs)
+            has_etg = has_etg or "EtgBridge.plugin" in copied
+            has_mandre = has_mandre or "mandre_lib.plugin" in copied
+        if not has_etg:
             logs.append("release file missing: EtgBridge.plugin")
             etg_file = ""
-        if not os.path.isfile(mandre_file):
+        if not has_mandre:
             logs.append("release file missing: mandre_lib.plugin")
             mandre_file = ""
         return etg_file, mandre_file
@@ -3038,7 +3409,7 @@ class EtgBridgeMod(loader.Module):
         same_device: typing.Optional[bool],
     ):
         await call.edit(self._t(lang, "installing", port=port))
-        sudo_ctx = self._get_sudo_ctx()
+        sudo_ctx = await _run_bg(self._get_sudo_ctx)
         if sudo_ctx.get("needs_password") and not sudo_ctx.get("password"):
             self._pending_install = {
                 "port": port,
@@ -3075,7 +3446,7 @@ class EtgBridgeMod(loader.Module):
             password = (self.config["sudo_password"] or "").strip()
             if not password:
                 continue
-            sudo_ctx = self._get_sudo_ctx()
+            sudo_ctx = await _run_bg(self._get_sudo_ctx)
             if sudo_ctx.get("password_invalid"):
                 try:
                     self.config["sudo_password"] = ""
@@ -3106,7 +3477,7 @@ class EtgBridgeMod(loader.Module):
         sudo_ctx: dict,
     ) -> bool:
         try:
-            _log_lines, etg_file, mandre_file, status = await asyncio.to_thread(
+            _log_lines, etg_file, mandre_file, status = await _run_bg(
                 self._run_install, port, sudo_ctx
             )
         except Exception as exc:
@@ -3132,10 +3503,13 @@ class EtgBridgeMod(loader.Module):
             await self._client.send_message(chat_id, manual_text)
             return False
 
-        if not (etg_file and os.path.isfile(etg_file)):
-            etg_file, _ = self._ensure_release_files([])
-        if not (mandre_file and os.path.isfile(mandre_file)):
-            _, mandre_file = self._ensure_release_files([])
+        if not (
+            etg_file
+            and mandre_file
+            and os.path.isfile(etg_file)
+            and os.path.isfile(mandre_file)
+        ):
+            etg_file, mandre_file = await _run_bg(self._ensure_release_files, [])
 
         await self._send_install_result(
             message=None,
@@ -3152,7 +3526,7 @@ class EtgBridgeMod(loader.Module):
 
     @loader.command(ru_doc="Удалить настройки ETG сервера")
     async def unetg(self, message: Message):
-        logs = await asyncio.to_thread(self._run_uninstall)
+        logs = await _run_bg(self._run_uninstall)
         text = "\n".join(logs) if logs else "Готово."
         await self._send_text_or_file(message, text, "etg_uninstall_log.txt", "ETG logs")
 
@@ -3173,12 +3547,11 @@ class EtgBridgeMod(loader.Module):
             )
             return
         if args in {"status", "info"}:
-            scheme = "https" if self.config["tls_enabled"] else "http"
-            server_state = (
-                f"{scheme}://{self.config['listen_host']}:{self.config['listen_port']}"
-            )
+            config = self.config
+            scheme = "https" if config["tls_enabled"] else "http"
+            server_state = f"{scheme}://{config['listen_host']}:{config['listen_port']}"
             if self._use_external():
-                data, err = self._fetch_status()
+                data, err = await _run_bg(self._fetch_status)
                 lines = [f"ETG bridge: external ({server_state})"]
                 if err:
                     lines.append(f"Server error: {err}")
@@ -3189,14 +3562,20 @@ class EtgBridgeMod(loader.Module):
                     lines.append("No devices yet")
                 else:
                     lines.append(f"Devices: {len(devices)}")
-                    for device in devices:
-                        lines.append(self._render_device_line(device))
+                    now = time.time()
+                    lines.extend(map(functools.partial(self._render_device_line, now=now), devices))
                 await utils.answer(message, "\n".join(lines))
                 return
 
-            with self._lock:
-                devices = list(self._devices.values())
             status = "running" if self._server else "stopped"
+            key = (self._devices_version, server_state, status, self._last_error)
+            cached = self._status_cache
+            tick = time.monotonic()
+            if cached is not None and cached[1] == key and tick - cached[0] < 0.5:
+                await utils.answer(message, cached[2])
+                return
+            with self._lock:
+                devices = tuple(self._devices.values())
             lines = [f"ETG bridge: {status} ({server_state})"]
             if self._last_error:
                 lines.append(f"Server error: {self._last_error}")
@@ -3204,9 +3583,11 @@ class EtgBridgeMod(loader.Module):
                 lines.append("No devices yet")
             else:
                 lines.append(f"Devices: {len(devices)}")
-                for device in devices:
-                    lines.append(self._render_device_line(device))
-            await utils.answer(message, "\n".join(lines))
+                now = time.time()
+                lines.extend(map(functools.partial(self._render_device_line, now=now), devices))
+            text = "\n".join(lines)
+            self._status_cache = (tick, key, text)
+            await utils.answer(message, text)
             return
 
         if not args:
@@ -3220,19 +3601,23 @@ class EtgBridgeMod(loader.Module):
             )
             return
 
-        free, error = self._port_is_free(port)
         note_key = ""
-        if not free:
-            if self._probe_health(port):
-                note_key = "confirm_note_existing"
-            else:
-                await utils.answer(
-                    message,
-                    self._with_contact(
-                        "ru", self._t("ru", "port_busy", port=port, error=error)
-                    ),
-                )
-                return
+        likely_ours = self._server is not None or port == int(self.config["listen_port"])
+        if likely_ours and await _run_bg(self._probe_health, port):
+            note_key = "confirm_note_existing"
+        else:
+            free, error = self._port_is_free(port)
+            if not free:
+                if not likely_ours and await _run_bg(self._probe_health, port):
+                    note_key = "confirm_note_existing"
+                else:
+                    await utils.answer(
+                        message,
+                        self._with_contact(
+                            "ru", self._t("ru", "port_busy", port=port, error=error)
+                        ),
+                    )
+                    return
 
         text = f"{self._t('ru', 'choose_lang_title')} / {self._t('en', 'choose_lang_title')}\n"
         text += f"{self._t('ru', 'choose_lang_hint')} / {self._t('en', 'choose_lang_hint')}"